@@ -116,46 +116,75 @@ final class VoiceVerifier: @unchecked Sendable {
     // MARK: - Model Loading
 
     private func loadModel() {
-        // Try to load from bundle first
-        if let modelURL = Bundle.main.url(forResource: "SpeakerEmbedding", withExtension: "mlpackage") ??
-            Bundle.main.url(forResource: "SpeakerEmbedding", withExtension: "mlmodelc")
-        {
-            do {
-                model = try MLModel(contentsOf: modelURL)
-                logInfo("VoiceVerifier: Loaded model from bundle")
-                return
-            } catch {
-                logError("VoiceVerifier: Failed to load model from bundle: \(error)")
-            }
-        }
-
-        // Try common dev paths
-        // Paths relative to the working directory (for dev builds run via `swift run`)
-        let devPaths = [
-            URL(fileURLWithPath: "Resources/SpeakerEmbedding.mlpackage"),
+        // Try the bundle first, then common dev paths relative to the working
+        // directory (for dev builds run via `swift run`)
+        let roots = [
+            Bundle.main.resourceURL,
+            URL(fileURLWithPath: "Resources"),
             URL(fileURLWithPath: FileManager.default.currentDirectoryPath)
                 .deletingLastPathComponent()
                 .deletingLastPathComponent()
-                .appendingPathComponent("Resources/SpeakerEmbedding.mlpackage"),
-        ]
+                .appendingPathComponent("Resources"),
+        ].compactMap { $0 }
 
-        for path in devPaths {
+        // Within a root, a compiled model that fails to load falls back to the package next to it
+        let candidates = roots.flatMap { modelCandidates(in: $0) }
+        for path in candidates {
             logDebug("VoiceVerifier: Trying model path: \(path.path)")
-            if FileManager.default.fileExists(atPath: path.path) {
-                do {
-                    let compiledURL = try MLModel.compileModel(at: path)
-                    model = try MLModel(contentsOf: compiledURL)
-                    logInfo("VoiceVerifier: Loaded model from \(path.path)")
-                    return
-                } catch {
-                    logError("VoiceVerifier: Failed to compile model at \(path.path): \(error)")
-                }
+            do {
+                let compiledURL = try path.pathExtension == "mlmodelc" ? path : MLModel.compileModel(at: path)
+                model = try MLModel(contentsOf: compiledURL)
+                logInfo("VoiceVerifier: Loaded model from \(path.path)")
+                return
+            } catch {
+                logError("VoiceVerifier: Failed to load model at \(path.path): \(error)")
             }
         }
 
         logWarning("VoiceVerifier: Model not found in any location")
     }
 
+    /// Speaker embedding models to try loading from `directory`, in order.
+    ///
+    /// The `.mlmodelc` precompiled by the conversion scripts skips compiling at launch, but it is
+    /// an untracked local file. It is only tried when it is at least as new as the `.mlpackage`, so an
+    /// updated package (e.g. from `git pull`) is never shadowed by a stale compiled copy. The
+    /// package always follows it as a fallback.
+    private func modelCandidates(in directory: URL) -> [URL] {
+        let fileManager = FileManager.default
+        let packageURL = directory.appendingPathComponent("SpeakerEmbedding.mlpackage")
+        let compiledURL = directory.appendingPathComponent("SpeakerEmbedding.mlmodelc")
+        let packages = fileManager.fileExists(atPath: packageURL.path) ? [packageURL] : []
+
+        guard fileManager.fileExists(atPath: compiledURL.path) else { return packages }
+        guard !packages.isEmpty else { return [compiledURL] }
+
+        if let compiledDate = latestModificationDate(in: compiledURL),
+           let packageDate = latestModificationDate(in: packageURL),
+           compiledDate >= packageDate
+        {
+            return [compiledURL, packageURL]
+        }
+        logWarning("VoiceVerifier: Ignoring stale \(compiledURL.path); the .mlpackage is newer")
+        return packages
+    }
+
+    /// Latest modification date of any file inside a model directory.
+    private func latestModificationDate(in directory: URL) -> Date? {
+        let keys: Set<URLResourceKey> = [.contentModificationDateKey]
+        guard let enumerator = FileManager.default.enumerator(
+            at: directory,
+            includingPropertiesForKeys: Array(keys)
+        ) else { return nil }
+
+        var latest: Date?
+        for case let url as URL in enumerator {
+            guard let date = try? url.resourceValues(forKeys: keys).contentModificationDate else { continue }
+            latest = max(latest ?? date, date)
+        }
+        return latest
+    }
+
     // MARK: - Mel Spectrogram Computation
 
     /// Compute mel spectrogram from audio samples
@@ -241,8 +270,9 @@ final class VoiceVerifier: @unchecked Sendable {
 
     /// Generate a 256-dimensional speaker embedding from audio samples.
     /// Runs mel spectrogram computation and CoreML inference on a background thread.
+    /// The model outputs an unnormalized embedding; it is L2-normalized here.
     /// - Parameter audioSamples: Audio samples at 16kHz mono (needs ≥2 seconds).
-    /// - Returns: 256-dimensional embedding vector.
+    /// - Returns: L2-normalized 256-dimensional embedding vector.
     /// - Throws: `VoiceVerifierError` if the model is not loaded or audio is insufficient.
     func generateEmbedding(from audioSamples: [Float]) async throws -> [Float] {
         let capturedModel = lock.withLock { model }
@@ -278,10 +308,11 @@ final class VoiceVerifier: @unchecked Sendable {
             let startFrame = (melSpec.count - partialFrames) / 2
             let melSlice = Array(melSpec[startFrame..<startFrame + partialFrames])
 
-            // Create MLMultiArray for input: (1, 160, 40)
+            // Create MLMultiArray for input: (1, 160, 40).
+            // FP16 matches the model's input type, so CoreML skips the entry cast.
             let inputArray = try MLMultiArray(
                 shape: [1, NSNumber(value: partialFrames), NSNumber(value: Self.nMels)],
-                dataType: .float32
+                dataType: .float16
             )
             for (frameIdx, frame) in melSlice.enumerated() {
                 for (melIdx, value) in frame.enumerated() {
@@ -296,7 +327,11 @@ final class VoiceVerifier: @unchecked Sendable {
 
             let output = try capturedModel.prediction(from: inputFeatures)
 
-            guard let embeddingArray = output.featureValue(for: "embedding")?.multiArrayValue else {
+            // A model with a different embedding size (e.g. the 128-dim dev model) must not be read
+            // past its end
+            guard let embeddingArray = output.featureValue(for: "embedding")?.multiArrayValue,
+                  embeddingArray.count == Self.embeddingDimension
+            else {
                 throw VoiceVerifierError.invalidOutput
             }
 
@@ -305,7 +340,7 @@ final class VoiceVerifier: @unchecked Sendable {
                 embedding[i] = embeddingArray[i].floatValue
             }
 
-            return embedding
+            return l2Normalize(embedding)
         }.value
     }
 
@@ -378,8 +413,7 @@ final class VoiceVerifier: @unchecked Sendable {
         }
 
         let currentEmbedding = try await generateEmbedding(from: audioSamples)
-        let normalized = l2Normalize(currentEmbedding)
-        let similarity = cosineSimilarity(enrolled, normalized)
+        let similarity = cosineSimilarity(enrolled, currentEmbedding)
         let isMatch = similarity >= threshold
 
         logInfo(
@@ -1,47 +1,42 @@
 #!/usr/bin/env python3
 """
-Convert Silero Speaker Verification model to CoreML format.
+Convert a simple speaker embedding model to CoreML format.
 
-The Silero model produces 256-dimensional speaker embeddings.
-Same speaker = similar embeddings (high cosine similarity).
+This is a lightweight development stand-in for a pre-trained Silero speaker
+model: a small CNN over log-mel spectrograms that produces 128-dimensional
+speaker embeddings. Same speaker = similar embeddings (high cosine similarity).
+
+Silero only publishes a VAD model via torch.hub, not a speaker model, so
+nothing is downloaded here. See download_resemblyzer.py for the pre-trained
+model the app ships.
 """
 
-import os
-import sys
-import urllib.request
+from pathlib import Path
 
-# Check dependencies
-try:
-    import torch
-    import coremltools as ct
-except ImportError:
-    print("Installing dependencies...")
-    os.system("pip3 install torch coremltools")
-    import torch
-    import coremltools as ct
+from coreml_utils import (
+    ensure_packages,
+    example_inputs,
+    export_and_convert,
+    publish_model,
+    quantize_weights_int8,
+    validate_coreml_model,
+)
 
-def download_silero_model():
-    """Download the Silero speaker verification model."""
-    print("Downloading Silero speaker verification model...")
-    
-    # Load from torch hub
-    model, utils = torch.hub.load(
-        repo_or_dir='snakers4/silero-vad',
-        model='silero_vad',
-        force_reload=False,
-        onnx=False
-    )
-    
-    # Actually we need the speaker model, not VAD
-    # Let's try the speaker embedding model
-    print("Note: Using silero-vad for now. For speaker verification, we need a different approach.")
-    return None
+ensure_packages("torch", "coremltools")
+
+import torch
 
 def create_simple_embedding_model():
     """
-    Create a simple speaker embedding model using MFCC features.
+    Create a simple speaker embedding model using log-mel features.
     This is a lightweight alternative while we figure out the full Silero integration.
     
+    The model takes a precomputed log-mel spectrogram instead of raw audio, so
+    the STFT runs on the Swift side with Accelerate/vDSP rather than as a
+    strided Conv1d in CoreML. VoiceVerifier.swift already produces the expected
+    input: 40 mel bands, 25ms window (400 samples), 10ms hop (160 samples),
+    512-point FFT at 16kHz, 160 frames per partial.
+    
     For production, we should use:
     - Silero speaker verification: https://github.com/snakers4/silero-models
     - Or ECAPA-TDNN from SpeechBrain
@@ -52,78 +47,97 @@ def create_simple_embedding_model():
     class SimpleSpeakerEmbedding(nn.Module):
         """
         Simple speaker embedding model.
-        Input: Audio waveform (16kHz, mono)
-        Output: 128-dimensional embedding
+        Input: Log-mel spectrogram (n_frames, 40 mel bands)
+        Output: 128-dimensional embedding (unnormalized)
         """
         def __init__(self):
             super().__init__()
-            # Simple 1D CNN for audio processing
-            self.conv1 = nn.Conv1d(1, 32, kernel_size=80, stride=16)  # ~5ms at 16kHz
-            self.conv2 = nn.Conv1d(32, 64, kernel_size=3, stride=2)
-            self.conv3 = nn.Conv1d(64, 128, kernel_size=3, stride=2)
-            self.pool = nn.AdaptiveAvgPool1d(1)
-            self.fc = nn.Linear(128, 128)
+            # Simple 2D CNN over (time, mel) for audio processing
+            self.conv1 = nn.Conv2d(1, 32, kernel_size=3, stride=2)
+            self.conv2 = nn.Conv2d(32, 64, kernel_size=3, stride=2)
+            self.conv3 = nn.Conv2d(64, 128, kernel_size=3, stride=2)
+            # Mean + std statistics pooling (x-vector style) feeds the projection
+            self.fc = nn.Linear(256, 128)
             self.relu = nn.ReLU()
             
         def forward(self, x):
-            # x shape: (batch, samples) - e.g., (1, 32000) for 2 seconds
-            x = x.unsqueeze(1)  # (batch, 1, samples)
+            # x shape: (batch, n_frames, n_mels) - e.g., (1, 160, 40)
+            x = x.unsqueeze(1)  # (batch, 1, n_frames, n_mels)
             x = self.relu(self.conv1(x))
             x = self.relu(self.conv2(x))
             x = self.relu(self.conv3(x))
-            x = self.pool(x)
-            x = x.squeeze(-1)
-            x = self.fc(x)
-            # L2 normalize for cosine similarity
-            x = x / (x.norm(dim=1, keepdim=True) + 1e-8)
+            x = x.mean(dim=3)  # Collapse mel axis: (batch, 128, frames)
+            # Statistics pooling over time keeps more temporal information
+            # than a plain average at the same cost
+            mean = x.mean(dim=2)
+            std = x.std(dim=2)
+            x = self.fc(torch.cat([mean, std], dim=1))
+            # No L2 normalize here: keeping it out of the quantized graph gives
+            # the projection tighter INT8 scales. Callers normalize in Swift.
             return x
     
     return SimpleSpeakerEmbedding()
 
-def convert_to_coreml(model, output_path):
-    """Convert PyTorch model to CoreML."""
+def convert_to_coreml(model, output_path, fp16_path):
+    """
+    Convert PyTorch model to CoreML.
+    
+    The INT8 model goes to `output_path`. The unquantized FP16 model is kept
+    at `fp16_path` for comparison.
+    """
     print("Converting to CoreML...")
     
     model.eval()
     
-    # Trace with example input (2 seconds of audio at 16kHz)
-    example_input = torch.randn(1, 32000)
-    traced_model = torch.jit.trace(model, example_input)
+    # Trace with example input (160 frames of 40-band log-mel, ~1.6s of audio)
+    n_frames = 160
+    example_input, test_input = example_inputs((1, n_frames, 40))
     
     # Convert to CoreML
-    mlmodel = ct.convert(
-        traced_model,
-        inputs=[ct.TensorType(name="audio", shape=(1, 32000))],
-        outputs=[ct.TensorType(name="embedding")],
-        minimum_deployment_target=ct.target.macOS14,
-    )
+    mlmodel = export_and_convert(model, example_input, (1, n_frames, 40))
     
     # Add metadata
     mlmodel.author = "Hisohiso"
     mlmodel.short_description = "Speaker embedding model for voice verification"
     mlmodel.version = "1.0"
     
-    # Save
-    mlmodel.save(output_path)
-    print(f"Saved CoreML model to: {output_path}")
+    validate_coreml_model(model, mlmodel, test_input)
+    fp16_model = mlmodel
+    
+    # Quantize Conv/Linear weights to INT8. The kernels are small, so
+    # per-channel symmetric quantization loses very little accuracy.
+    mlmodel = quantize_weights_int8(mlmodel)
+    validate_coreml_model(model, mlmodel, test_input)
+    
+    # Save only once both variants passed validation
+    publish_model(mlmodel, output_path)
+    
+    # Keep the FP16 model as a build byproduct
+    Path(fp16_path).parent.mkdir(parents=True, exist_ok=True)
+    fp16_model.save(str(fp16_path))
+    print(f"Saved FP16 byproduct model to: {fp16_path}")
     
     return mlmodel
 
 def main():
-    output_dir = os.path.join(os.path.dirname(__file__), "..", "Resources")
-    os.makedirs(output_dir, exist_ok=True)
-    output_path = os.path.join(output_dir, "SpeakerEmbedding.mlpackage")
+    # The app loads Resources/SpeakerEmbedding, which must be the 256-dim
+    # Resemblyzer model; this 128-dim stand-in stays under build/
+    build_dir = (Path(__file__).parent / ".." / "build" / "coreml").resolve()
+    output_path = build_dir / "SimpleSpeakerEmbedding.mlpackage"
+    fp16_path = build_dir / "SimpleSpeakerEmbedding-fp16.mlpackage"
     
     print("Creating speaker embedding model...")
     model = create_simple_embedding_model()
     
     print(f"Model parameters: {sum(p.numel() for p in model.parameters()):,}")
     
-    convert_to_coreml(model, output_path)
+    convert_to_coreml(model, str(output_path), fp16_path)
     
-    print("\nDone! Model saved to Resources/SpeakerEmbedding.mlpackage")
+    print(f"\nDone! Model saved to {output_path}")
     print("\nNote: This is a simple model for development. For production,")
     print("consider using a pre-trained model like ECAPA-TDNN or Resemblyzer.")
+    print("The embedding output is not L2-normalized; callers must normalize it")
+    print("(VoiceVerifier.swift does this with vDSP after prediction).")
 
 if __name__ == "__main__":
     main()
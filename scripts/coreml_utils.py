@@ -0,0 +1,212 @@
+"""
+Shared helpers for the speaker embedding CoreML conversion scripts.
+
+Only the standard library is imported at module level so the scripts can
+call ensure_packages() before torch and coremltools are installed.
+"""
+
+import importlib.util
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+def ensure_packages(*packages, install=None):
+    """
+    Install dependencies if any of `packages` is missing.
+
+    Uses importlib.util.find_spec so nothing is imported just to check.
+    `install` overrides the pip requirement list (defaults to `packages`).
+    """
+    if any(importlib.util.find_spec(pkg) is None for pkg in packages):
+        print("Installing dependencies...")
+        os.system(f"pip3 install {' '.join(install or packages)}")
+
+def example_inputs(shape):
+    """
+    Return (trace_input, test_input) for a model input of `shape`.
+
+    Zeros keep tracing deterministic since only the shape matters there;
+    parity checks need non-trivial values, so the test input is random.
+    """
+    import torch
+    return torch.zeros(*shape), torch.randn(*shape)
+
+def trace_model(model, example_input):
+    """
+    Capture the model graph with torch.jit.trace.
+
+    Freezing inlines weights and folds constants before conversion. Models
+    with recurrent layers are left unfrozen: freezing turns their flat
+    weight list into a constant that coremltools cannot convert.
+    optimize_for_mobile is skipped: it rewrites conv/linear into XNNPACK
+    prepacked ops that coremltools cannot convert.
+    """
+    import torch
+    with torch.inference_mode():
+        traced = torch.jit.trace(model, example_input)
+    if any(isinstance(m, torch.nn.RNNBase) for m in model.modules()):
+        return traced
+    return torch.jit.freeze(traced)
+
+def convert_embedding_model(program, input_shape, **kwargs):
+    """
+    Convert a captured model with the settings shared by all speaker models.
+
+    The input is `mel_spectrogram` and the output `embedding`; keyword
+    arguments are passed through to ct.convert and override the defaults.
+    """
+    import numpy as np
+    import coremltools as ct
+    options = dict(
+        # FP16 I/O avoids a cast at the model boundary on every prediction
+        inputs=[ct.TensorType(name="mel_spectrogram", shape=input_shape, dtype=np.float16)],
+        outputs=[ct.TensorType(name="embedding", dtype=np.float16)],
+        minimum_deployment_target=ct.target.macOS14,
+        # These match the mlprogram defaults; pinned on purpose so a change in
+        # coremltools defaults can't silently move the model back to FP32
+        compute_precision=ct.precision.FLOAT16,
+        compute_units=ct.ComputeUnit.ALL,
+    )
+    options.update(kwargs)
+    return ct.convert(program, **options)
+
+def export_and_convert(model, example_input, input_shape, dynamic_shapes=None, **kwargs):
+    """
+    Capture `model` and convert it with convert_embedding_model.
+
+    Prefers torch.export, which unlocks newer MIL passes in coremltools.
+    The ExportedProgram frontend supports fewer ops and input options than
+    TorchScript, so if either export or conversion fails, the model is
+    converted again from a torch.jit.trace.
+    """
+    import torch
+    try:
+        program = torch.export.export(model, (example_input,), dynamic_shapes=dynamic_shapes)
+        # coremltools only accepts the ATEN dialect; newer torch exports the
+        # TRAINING dialect until it is decomposed
+        program = program.run_decompositions({})
+        return convert_embedding_model(program, input_shape, **kwargs)
+    except Exception as e:
+        print(f"torch.export conversion failed ({e}), falling back to torch.jit.trace")
+    return convert_embedding_model(trace_model(model, example_input), input_shape, **kwargs)
+
+def quantize_weights_int8(mlmodel):
+    """
+    Quantize weights to per-channel symmetric INT8.
+
+    Supported on macOS 14 and keeps error small: each output channel gets
+    its own scale, so one large row can't crush the resolution of the rest.
+    """
+    from coremltools.optimize.coreml import (
+        OpLinearQuantizerConfig,
+        OptimizationConfig,
+        linear_quantize_weights,
+    )
+    print("Quantizing weights to INT8...")
+    quantize_config = OptimizationConfig(
+        global_config=OpLinearQuantizerConfig(
+            mode="linear_symmetric", dtype="int8", granularity="per_channel"
+        )
+    )
+    return linear_quantize_weights(mlmodel, quantize_config)
+
+def palettize_weights_4bit(mlmodel, group_size=16):
+    """
+    Palettize weights to 4-bit k-means lookup tables, one per group of
+    `group_size` output channels.
+
+    Grouped-channel palettization needs a macOS 15 deployment target. A
+    single per-tensor palette of 16 values is too coarse for the LSTM, so
+    each group of rows gets its own.
+    """
+    from coremltools.optimize.coreml import (
+        OpPalettizerConfig,
+        OptimizationConfig,
+        palettize_weights,
+    )
+    print(f"Palettizing weights to 4 bits (groups of {group_size} channels)...")
+    palettize_config = OptimizationConfig(
+        global_config=OpPalettizerConfig(
+            mode="kmeans", nbits=4, granularity="per_grouped_channel", group_size=group_size
+        )
+    )
+    return palettize_weights(mlmodel, palettize_config)
+
+def check_embedding_parity(ref, out, min_cosine=0.99):
+    """
+    Compare CoreML embeddings `out` against PyTorch embeddings `ref`.
+
+    Embeddings are compared by cosine similarity, which is what voice
+    verification scores on. Raises RuntimeError on drift so a broken
+    conversion is never saved.
+    """
+    import numpy as np
+    out = out.astype(np.float32)
+    max_diff = np.max(np.abs(ref - out))
+    cosine = np.sum(ref * out, axis=1) / (
+        np.linalg.norm(ref, axis=1) * np.linalg.norm(out, axis=1) + 1e-8
+    )
+    print(f"  Max abs diff: {max_diff:.4f}, min cosine similarity: {cosine.min():.4f}")
+    if cosine.min() < min_cosine:
+        raise RuntimeError(
+            f"CoreML output drifted from PyTorch (cosine {cosine.min():.4f} < {min_cosine})"
+        )
+
+def validate_coreml_model(model, mlmodel, test_input, min_cosine=0.99, n_runs=20):
+    """
+    Check CoreML output against PyTorch and report prediction latency.
+
+    See check_embedding_parity for the pass criterion.
+    """
+    import numpy as np
+    import torch
+    print("Validating CoreML model...")
+    with torch.no_grad():
+        ref = model(test_input).numpy()
+    inputs = {"mel_spectrogram": test_input.numpy().astype(np.float16)}
+    check_embedding_parity(ref, mlmodel.predict(inputs)["embedding"], min_cosine)
+
+    start = time.perf_counter()
+    for _ in range(n_runs):
+        mlmodel.predict(inputs)
+    print(f"  CoreML latency: {(time.perf_counter() - start) / n_runs * 1000:.2f} ms")
+
+def publish_model(mlmodel, output_path):
+    """
+    Save `mlmodel` as an .mlpackage plus a precompiled .mlmodelc.
+
+    Shipping the compiled model lets the first load on device skip CoreML
+    compilation. Both are written to a staging directory first; the previous
+    package and compiled model are only moved to *.backup once the new ones
+    exist, so a failed save or compile leaves the old model in place.
+    """
+    import coremltools as ct
+    output_path = Path(output_path)
+    compiled_path = output_path.with_suffix(".mlmodelc")
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    staging_dir = Path(tempfile.mkdtemp(prefix=".staging-", dir=output_path.parent))
+    try:
+        staged_package = staging_dir / output_path.name
+        mlmodel.save(str(staged_package))
+        staged_compiled = Path(
+            ct.utils.compile_model(str(staged_package), str(staging_dir / compiled_path.name))
+        )
+
+        for path in (output_path, compiled_path):
+            backup_path = path.with_suffix(path.suffix + ".backup")
+            if path.exists():
+                if backup_path.exists():
+                    shutil.rmtree(backup_path)
+                path.rename(backup_path)
+                print(f"Backed up old model to {backup_path}")
+
+        staged_package.rename(output_path)
+        staged_compiled.rename(compiled_path)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    print(f"Saved CoreML model to: {output_path}")
+    print(f"Compiled to {compiled_path}")
@@ -7,111 +7,426 @@ produces 256-dimensional speaker embeddings. It's based on the paper
 "Generalized End-to-End Loss for Speaker Verification" (Google, 2018).
 """
 
-import os
-import sys
+import argparse
+import copy
+from pathlib import Path
+from typing import Optional
 
-def install_deps():
-    """Install required dependencies."""
-    print("Installing dependencies...")
-    os.system("pip3 install torch torchaudio resemblyzer coremltools soundfile")
+from coreml_utils import (
+    check_embedding_parity,
+    convert_embedding_model,
+    ensure_packages,
+    example_inputs,
+    export_and_convert,
+    palettize_weights_4bit,
+    publish_model,
+    quantize_weights_int8,
+    validate_coreml_model,
+)
 
-try:
-    import torch
-    import coremltools as ct
-    from resemblyzer import VoiceEncoder
-except ImportError:
-    install_deps()
-    import torch
-    import coremltools as ct
-    from resemblyzer import VoiceEncoder
+ensure_packages(
+    "torch",
+    "coremltools",
+    "resemblyzer",
+    install=("torch", "torchaudio", "resemblyzer", "coremltools", "soundfile"),
+)
 
-def convert_resemblyzer_to_coreml(output_path: str):
+import torch
+import coremltools as ct
+from resemblyzer import VoiceEncoder
+
+class ResemblyzerWrapper(torch.nn.Module):
+    """Wrapper that takes mel spectrograms and returns embeddings."""
+    def __init__(self, encoder):
+        super().__init__()
+        # Unidirectional, so the last output step equals the top layer's
+        # final hidden state
+        assert not encoder.lstm.bidirectional
+        self.lstm = encoder.lstm
+        self.linear = encoder.linear
+        self.relu = torch.nn.ReLU()
+        
+    def forward(self, mels):
+        # mels: (batch, n_frames, 40)
+        # LSTM expects (batch, seq, features)
+        out, _ = self.lstm(mels)
+        # Take the last output step; slicing the sequence output avoids
+        # the extra rank change of indexing the stacked hidden state
+        embeds_raw = self.relu(self.linear(out[:, -1, :]))
+        # L2 normalization happens in Swift (vDSP) so it stays out of the
+        # quantized graph
+        return embeds_raw
+
+def load_voice_encoder():
+    """Load the pre-trained Resemblyzer VoiceEncoder in eval mode."""
+    print("Loading Resemblyzer model...")
+    # Weights ship inside the resemblyzer package, so there is nothing to
+    # download or cache; pin to CPU to skip CUDA initialization, and because
+    # the model is traced with CPU tensors anyway
+    encoder = VoiceEncoder(device="cpu")
+    encoder.eval()
+    return encoder
+
+def distill_gru_wrapper(teacher, audio_dir: str, epochs: int = 1, min_cosine: float = 0.95):
+    """
+    Distill the Resemblyzer LSTM into a same-width GRU.
+    
+    A GRU has 3 gates instead of 4, so the recurrent matmuls (the bulk of
+    inference) shrink by ~25%. The GRU starts from the LSTM weights (update
+    gate <- forget gate, candidate <- cell gate, reset gate <- average of
+    input and forget gates), then trains to match the teacher's embeddings
+    on partials cut from the .wav/.flac/.mp3 files in `audio_dir`.
+    
+    Every tenth file (at least one) is held out from training. Raises
+    RuntimeError if the mean teacher-vs-student cosine similarity on the
+    held-out partials is below `min_cosine`, so a poorly distilled GRU is
+    never converted.
+    
+    Embeddings from the GRU model are not guaranteed to match voices
+    enrolled with the LSTM model; users should re-enroll.
+    """
+    from resemblyzer import preprocess_wav
+    from resemblyzer.audio import wav_to_mel_spectrogram
+    
+    print(f"Collecting distillation partials from {audio_dir}...")
+    partial_frames, step = 160, 80
+    file_partials = []
+    for path in sorted(Path(audio_dir).rglob("*")):
+        if path.suffix.lower() not in (".wav", ".flac", ".mp3"):
+            continue
+        mel = wav_to_mel_spectrogram(preprocess_wav(path))
+        partials = [
+            torch.from_numpy(mel[start:start + partial_frames])
+            for start in range(0, len(mel) - partial_frames + 1, step)
+        ]
+        if partials:
+            file_partials.append(partials)
+    if len(file_partials) < 2:
+        raise RuntimeError(f"Need at least 2 usable audio files in {audio_dir} (one is held out)")
+    
+    # Hold out whole files so overlapping partials can't leak into training
+    held_out = [i for i in range(len(file_partials)) if i % 10 == 9] or [len(file_partials) - 1]
+    mels = torch.stack([p for i, f in enumerate(file_partials) if i not in held_out for p in f])
+    held_out_mels = torch.stack([p for i in held_out for p in file_partials[i]])
+    print(f"  {len(mels)} training partials, {len(held_out_mels)} held-out partials")
+    
+    batch_size = 32
+    
+    def embed(model, mels):
+        """Normalized embeddings for `mels`, computed in batches."""
+        with torch.no_grad():
+            return torch.cat([
+                torch.nn.functional.normalize(model(batch), dim=1)
+                for batch in mels.split(batch_size)
+            ])
+    
+    lstm = teacher.lstm
+    hidden_size = lstm.hidden_size
+    
+    class GruResemblyzerWrapper(torch.nn.Module):
+        """Wrapper that runs a GRU in place of the Resemblyzer LSTM."""
+        def __init__(self, teacher):
+            super().__init__()
+            self.gru = torch.nn.GRU(
+                lstm.input_size, hidden_size, num_layers=lstm.num_layers, batch_first=True
+            )
+            self.linear = copy.deepcopy(teacher.linear)
+            self.relu = torch.nn.ReLU()
+            
+        def forward(self, mels):
+            # mels: (batch, n_frames, 40)
+            out, _ = self.gru(mels)
+            embeds_raw = self.relu(self.linear(out[:, -1, :]))
+            return embeds_raw
+    
+    student = GruResemblyzerWrapper(teacher)
+    
+    # PyTorch packs LSTM gates as (input, forget, cell, output) and GRU gates
+    # as (reset, update, new)
+    with torch.no_grad():
+        for name, gru_param in student.gru.named_parameters():
+            i, f, g, _ = getattr(lstm, name).chunk(4)
+            gru_param.copy_(torch.cat([(i + f) / 2, f, g]))
+    
+    targets = embed(teacher, mels)
+    
+    print(f"Distilling GRU for {epochs} epoch(s)...")
+    optimizer = torch.optim.Adam(student.parameters(), lr=1e-3)
+    student.train()
+    for epoch in range(epochs):
+        order = torch.randperm(len(mels))
+        total = 0.0
+        for batch in order.split(batch_size):
+            embeds = torch.nn.functional.normalize(student(mels[batch]), dim=1)
+            loss = (1 - (embeds * targets[batch]).sum(dim=1)).mean()
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(batch)
+        print(f"  Epoch {epoch + 1}: mean cosine distance {total / len(mels):.4f}")
+    student.eval()
+    
+    # Gate on unseen audio against the LSTM teacher, not the student itself
+    held_out_cosine = (embed(student, held_out_mels) * embed(teacher, held_out_mels)).sum(dim=1)
+    print(f"  Held-out teacher/student cosine similarity: mean {held_out_cosine.mean():.4f}, "
+          f"min {held_out_cosine.min():.4f}")
+    if held_out_cosine.mean() < min_cosine:
+        raise RuntimeError(
+            f"Distilled GRU does not match the LSTM on held-out audio "
+            f"(mean cosine {held_out_cosine.mean():.4f} < {min_cosine})"
+        )
+    return student
+
+def convert_resemblyzer_to_coreml(
+    output_path: str, gru_audio_dir: Optional[str] = None, palettize: bool = False
+):
     """
     Convert Resemblyzer VoiceEncoder to CoreML format.
     
     The model expects:
     - Input: mel spectrogram frames (batch, n_frames, 40)
-    - Output: 256-dimensional embedding
+    - Output: 256-dimensional embedding (unnormalized; callers L2-normalize)
     
     For simplicity, we'll create a wrapper that takes raw audio.
+    
+    If `gru_audio_dir` is given, the LSTM is distilled into a GRU on that
+    audio before conversion (see distill_gru_wrapper).
+    
+    Weights are quantized to per-channel INT8 by default. With `palettize`,
+    they are palettized to grouped-channel 4-bit LUTs instead, which needs
+    macOS 15.
     """
-    print("Loading Resemblyzer model...")
-    encoder = VoiceEncoder()
-    encoder.eval()
+    encoder = load_voice_encoder()
     
     # Resemblyzer's forward expects mel spectrogram partials
     # Shape: (batch_size, n_frames, 40) where 40 is mel channels
     # We need at least 160 frames (partial_n_frames)
     
     print("Creating traceable wrapper...")
+    wrapper = ResemblyzerWrapper(encoder)
+    wrapper.eval()
+    
+    if gru_audio_dir:
+        wrapper = distill_gru_wrapper(wrapper, gru_audio_dir)
     
-    class ResemblyzerWrapper(torch.nn.Module):
-        """Wrapper that takes mel spectrograms and returns embeddings."""
+    # Trace with example input
+    # 160 frames is the default partial length in Resemblyzer
+    n_frames = 160
+    example_input, _ = example_inputs((1, n_frames, 40))
+    
+    # Callers average many 1.6s partials per utterance, so accept a small set
+    # of batch sizes and score them in one dispatch. Enumerated shapes still
+    # run on the Neural Engine, unlike fully flexible RangeDim inputs.
+    batch_sizes = (1, 4, 8)
+    input_shape = ct.EnumeratedShapes(
+        shapes=[(batch, n_frames, 40) for batch in batch_sizes],
+        default=(1, n_frames, 40),
+    )
+    
+    # torch.export specializes dims whose example size is 1, so export with a
+    # larger batch to keep the batch dim symbolic
+    batch_dim = torch.export.Dim("batch", min=1, max=max(batch_sizes))
+    
+    # Every enumerated shape is its own compiled function, so check each one
+    test_inputs = [example_inputs((batch, n_frames, 40))[1] for batch in batch_sizes]
+    
+    def validate(mlmodel):
+        for test_input in test_inputs:
+            print(f"Batch size {len(test_input)}:")
+            validate_coreml_model(wrapper, mlmodel, test_input)
+    
+    print("Converting to CoreML...")
+    mlmodel = export_and_convert(
+        wrapper,
+        example_input.repeat(batch_sizes[1], 1, 1),
+        input_shape,
+        dynamic_shapes=({0: batch_dim},),
+        # Grouped-channel palettization needs the macOS 15 opset
+        minimum_deployment_target=ct.target.macOS15 if palettize else ct.target.macOS14,
+    )
+    
+    # Check the FP16 model first so drift can be pinned on either the
+    # conversion or the weight compression below
+    validate(mlmodel)
+    
+    # Compress weights. The LSTM dominates model size and is memory-bound,
+    # so fewer weight bytes means less DRAM traffic per call.
+    if palettize:
+        mlmodel = palettize_weights_4bit(mlmodel)
+    else:
+        mlmodel = quantize_weights_int8(mlmodel)
+    
+    # Add metadata
+    mlmodel.author = "Hisohiso (Resemblyzer)"
+    mlmodel.short_description = "Speaker embedding model based on GE2E loss"
+    mlmodel.version = "1.0"
+    
+    # Compression is lossy; refuse to save if it drifted too far
+    validate(mlmodel)
+    
+    publish_model(mlmodel, output_path)
+    
+    # Verify output dimension
+    print(f"\nModel info:")
+    print(f"  Input: mel_spectrogram (batch, {n_frames}, 40), batch in {batch_sizes}")
+    print(f"  Output: embedding (batch, 256), not L2-normalized")
+    
+    return mlmodel
+
+def convert_streaming_resemblyzer_to_coreml(output_path: str):
+    """
+    Convert Resemblyzer VoiceEncoder to a stateful CoreML model for streaming.
+    
+    The LSTM (h, c) state lives in CoreML model state and carries across
+    calls, so a caller can feed a 160-frame partial as two 80-frame chunks
+    while audio arrives. The embedding is then ready one chunk after the
+    partial ends, without waiting for a 160-frame batch call.
+    
+    The state covers everything fed since it was created. Only an embedding
+    read after exactly two chunks from a fresh state matches the batch
+    model's per-partial embedding, which is what enrollment uses. Reading it
+    after more chunks gives context GE2E was never trained on, and the result
+    is not comparable to enrolled voices. Callers must start a new state for
+    every partial. Overlapping partials therefore each need their own state
+    and are not cheaper than the batch model in total LSTM work.
+    
+    The model expects:
+    - Input: new mel spectrogram frames (1, 80, 40)
+    - State: h, c (3, 1, 256), updated in place on each prediction
+    - Output: 256-dimensional embedding (unnormalized); valid after the
+      second chunk of a fresh state
+    
+    The converted model is run through an MLState on two chunks and checked
+    against the batch PyTorch model before it is published.
+    
+    Stateful models need macOS 15. The app still supports macOS 14, so this
+    is a separate opt-in artifact. Swift wiring:
+    
+        let state = model.makeState()  // new state per 160-frame partial
+        _ = try await model.prediction(from: firstChunk, using: state)
+        let output = try await model.prediction(from: secondChunk, using: state)
+    """
+    encoder = load_voice_encoder()
+    
+    num_layers = encoder.lstm.num_layers
+    hidden_size = encoder.lstm.hidden_size
+    
+    class StreamingResemblyzerWrapper(torch.nn.Module):
+        """Wrapper that keeps LSTM state in buffers between calls."""
         def __init__(self, encoder):
             super().__init__()
             self.lstm = encoder.lstm
             self.linear = encoder.linear
             self.relu = torch.nn.ReLU()
+            # Registered buffers become CoreML states
+            self.register_buffer("h", torch.zeros(num_layers, 1, hidden_size))
+            self.register_buffer("c", torch.zeros(num_layers, 1, hidden_size))
             
         def forward(self, mels):
-            # mels: (batch, n_frames, 40)
-            # LSTM expects (batch, seq, features)
-            out, (hidden, _) = self.lstm(mels)
-            # Take the last hidden state
-            embeds_raw = self.relu(self.linear(hidden[-1]))
-            # L2 normalize
-            embeds = embeds_raw / (torch.norm(embeds_raw, dim=1, keepdim=True) + 1e-5)
-            return embeds
+            # mels: (1, n_new_frames, 40)
+            out, (hidden, cell) = self.lstm(mels, (self.h, self.c))
+            # coremltools maps slice assignment to a state write; copy_ and
+            # [...] assignment fail to convert
+            self.h[:, :, :] = hidden
+            self.c[:, :, :] = cell
+            embeds_raw = self.relu(self.linear(out[:, -1, :]))
+            return embeds_raw
     
-    wrapper = ResemblyzerWrapper(encoder)
+    wrapper = StreamingResemblyzerWrapper(encoder)
     wrapper.eval()
     
-    # Trace with example input
-    # 160 frames is the default partial length in Resemblyzer
-    n_frames = 160
-    example_input = torch.randn(1, n_frames, 40)
+    # Half a partial per call, matching Resemblyzer's default ~50% overlap
+    chunk_frames = 80
+    example_input, _ = example_inputs((1, chunk_frames, 40))
     
-    print("Tracing model...")
-    traced = torch.jit.trace(wrapper, example_input)
+    # Two fresh-state chunks must reproduce the batch model on one partial
+    print("Checking streaming parity...")
+    _, partial = example_inputs((1, 2 * chunk_frames, 40))
+    with torch.no_grad():
+        expected = ResemblyzerWrapper(encoder)(partial)
+        wrapper(partial[:, :chunk_frames])
+        streamed = wrapper(partial[:, chunk_frames:])
+    wrapper.h.zero_()
+    wrapper.c.zero_()
+    if not torch.allclose(streamed, expected, atol=1e-5):
+        max_diff = (streamed - expected).abs().max().item()
+        raise RuntimeError(f"Streaming output differs from batch model (max abs diff {max_diff:.6f})")
     
-    print("Converting to CoreML...")
-    mlmodel = ct.convert(
+    # Stateful conversion goes through the TorchScript frontend
+    print("Tracing streaming model...")
+    with torch.inference_mode():
+        traced = torch.jit.trace(wrapper, example_input)
+    # Tracing ran one chunk through the buffers; start conversion from zeros
+    wrapper.h.zero_()
+    wrapper.c.zero_()
+    
+    print("Converting streaming model to CoreML...")
+    state_shape = (num_layers, 1, hidden_size)
+    mlmodel = convert_embedding_model(
         traced,
-        inputs=[ct.TensorType(name="mel_spectrogram", shape=(1, n_frames, 40))],
-        outputs=[ct.TensorType(name="embedding")],
-        minimum_deployment_target=ct.target.macOS14,
+        (1, chunk_frames, 40),
+        states=[
+            ct.StateType(wrapped_type=ct.TensorType(shape=state_shape), name="h"),
+            ct.StateType(wrapped_type=ct.TensorType(shape=state_shape), name="c"),
+        ],
+        minimum_deployment_target=ct.target.macOS15,
     )
     
     # Add metadata
     mlmodel.author = "Hisohiso (Resemblyzer)"
-    mlmodel.short_description = "Speaker embedding model based on GE2E loss"
+    mlmodel.short_description = "Streaming speaker embedding model based on GE2E loss"
     mlmodel.version = "1.0"
     
-    mlmodel.save(output_path)
-    print(f"Saved CoreML model to: {output_path}")
+    # Feed a partial as two chunks through a fresh MLState, as callers will
+    print("Validating streaming CoreML model...")
+    state = mlmodel.make_state()
+    for chunk in partial.split(chunk_frames, dim=1):
+        output = mlmodel.predict({"mel_spectrogram": chunk.half().numpy()}, state=state)
+    check_embedding_parity(expected.numpy(), output["embedding"])
     
-    # Verify output dimension
-    print(f"\nModel info:")
-    print(f"  Input: mel_spectrogram (1, {n_frames}, 40)")
-    print(f"  Output: embedding (1, 256)")
+    publish_model(mlmodel, output_path)
     
     return mlmodel
 
 def main():
-    output_dir = os.path.join(os.path.dirname(__file__), "..", "Resources")
-    os.makedirs(output_dir, exist_ok=True)
-    output_path = os.path.join(output_dir, "SpeakerEmbedding.mlpackage")
-    
-    # Backup old model if exists
-    if os.path.exists(output_path):
-        import shutil
-        backup_path = output_path + ".backup"
-        if os.path.exists(backup_path):
-            shutil.rmtree(backup_path)
-        shutil.move(output_path, backup_path)
-        print(f"Backed up old model to {backup_path}")
-    
-    convert_resemblyzer_to_coreml(output_path)
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="also export a stateful streaming model (macOS 15+)",
+    )
+    parser.add_argument(
+        "--palettized",
+        action="store_true",
+        help="also export a grouped-channel 4-bit palettized model (macOS 15+)",
+    )
+    parser.add_argument(
+        "--gru",
+        metavar="AUDIO_DIR",
+        help="also export a GRU distilled from the LSTM on audio files in AUDIO_DIR",
+    )
+    args = parser.parse_args()
+    
+    output_dir = (Path(__file__).parent / ".." / "Resources").resolve()
+    output_path = output_dir / "SpeakerEmbedding.mlpackage"
+    
+    convert_resemblyzer_to_coreml(str(output_path))
+    
+    # Optional GRU variant, kept separate so it never replaces the default
+    # model that existing enrollments were made with
+    if args.gru:
+        gru_path = output_dir / "SpeakerEmbeddingGRU.mlpackage"
+        convert_resemblyzer_to_coreml(str(gru_path), gru_audio_dir=args.gru)
+    
+    # Optional 4-bit palettized model (macOS 15+), a quarter of the FP16 size
+    if args.palettized:
+        palettized_path = output_dir / "SpeakerEmbedding4bit.mlpackage"
+        convert_resemblyzer_to_coreml(str(palettized_path), palettize=True)
+    
+    # Optional stateful model for streaming callers (macOS 15+)
+    if args.streaming:
+        streaming_path = output_dir / "SpeakerEmbeddingStreaming.mlpackage"
+        convert_streaming_resemblyzer_to_coreml(str(streaming_path))
     
     print("\nDone! The model now uses pre-trained Resemblyzer weights.")
     print("Note: You'll need to update VoiceVerifier.swift to:")